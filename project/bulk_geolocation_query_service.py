@@ -1,10 +1,34 @@
-from typing import List, Optional
+import asyncio
+import ipaddress
+from typing import Dict, List, Literal, Optional, Set, Union
 
 import prisma
-import prisma.models
+import project.geolocation_table
 from fastapi import HTTPException
+from fastapi.responses import ORJSONResponse, Response
+from project.geolocation_cache import MISSING, GeolocationRow, geolocation_cache
 from pydantic import BaseModel
 
+# Response layouts of the bulk endpoint: an array of objects, an object of
+# parallel arrays, or an Apache Arrow IPC stream.
+BulkFormat = Literal["aos", "soa", "arrow"]
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+# Upper bound on the number of IP addresses sent in a single query.
+QUERY_CHUNK_SIZE = 1000
+
+# Only the columns used in the response are selected, which Prisma's find_many
+# can't express. Each address is matched to the most specific network block
+# containing it.
+BULK_GEOLOCATION_QUERY = (
+    'SELECT q.ip AS "ipAddress", g.country, g.city, g.latitude, g.longitude, g."ISP" '
+    "FROM unnest($1::text[]) AS q(ip) CROSS JOIN LATERAL ("
+    'SELECT country, city, latitude, longitude, "ISP" FROM "GeolocationData" '
+    'WHERE "ipAddress" >>= q.ip::inet ORDER BY masklen("ipAddress") DESC LIMIT 1'
+    ") AS g"
+)
+
 
 class GeolocationInfo(BaseModel):
     """
@@ -27,37 +51,118 @@ class BulkGeolocationQueryResponse(BaseModel):
     geolocation_data: List[GeolocationInfo]
 
 
+def _arrow_response(columns: dict) -> Response:
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        raise HTTPException(
+            status_code=406,
+            detail="Arrow output requires the server to be installed with pyarrow.",
+        )
+    batch = pyarrow.RecordBatch.from_pydict(columns)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return Response(
+        content=sink.getvalue().to_pybytes(), media_type=ARROW_STREAM_MEDIA_TYPE
+    )
+
+
+async def _fetch_rows(ip_addresses: Set[str]) -> Dict[str, Optional[GeolocationRow]]:
+    """
+    Looks up the geolocation rows of canonical IP addresses, querying the database only for cache misses.
+    """
+    rows_by_ip = {ip: geolocation_cache.get(ip) for ip in ip_addresses}
+    misses = [ip for ip, row in rows_by_ip.items() if row is MISSING]
+    chunks = await asyncio.gather(
+        *(
+            prisma.get_client().query_raw(
+                BULK_GEOLOCATION_QUERY, misses[i : i + QUERY_CHUNK_SIZE]
+            )
+            for i in range(0, len(misses), QUERY_CHUNK_SIZE)
+        )
+    )
+    for ip in misses:
+        rows_by_ip[ip] = None
+    for rows in chunks:
+        for geo_data in rows:
+            rows_by_ip[geo_data["ipAddress"]] = (
+                geo_data["country"],
+                geo_data["city"],
+                geo_data["latitude"],
+                geo_data["longitude"],
+                geo_data["ISP"],
+            )
+    for ip in misses:
+        geolocation_cache.set(ip, rows_by_ip[ip])
+    return rows_by_ip
+
+
 async def bulk_geolocation_query(
-    ip_addresses: List[str],
-) -> BulkGeolocationQueryResponse:
+    ip_addresses: List[str], format: BulkFormat = "aos"
+) -> Union[BulkGeolocationQueryResponse, Response]:
     """
     Processes a list of IP addresses and returns their geolocation data.
 
     Args:
     ip_addresses (List[str]): A list of IP addresses (IPv4 or IPv6) for which geolocation data is requested.
+    format (BulkFormat): "aos" for a list of GeolocationInfo objects, "soa" for a JSON object holding one list per
+    GeolocationInfo field, or "arrow" for the same columns as an Apache Arrow IPC stream.
 
     Returns:
-    BulkGeolocationQueryResponse: Response model encapsulating geolocation data for multiple IP addresses.
+    Union[BulkGeolocationQueryResponse, Response]: Response model encapsulating geolocation data for multiple IP
+    addresses, or for the columnar formats a response holding the encoded columns.
 
+    Raises:
+    HTTPException: If no IP addresses are provided, or with status 422 listing any that are malformed.
     """
     if not ip_addresses:
         raise HTTPException(status_code=400, detail="No IP addresses provided.")
-    geolocations = []
+    # Canonical forms keep equivalent spellings of an address on one cache entry.
+    addresses = []
+    invalid = []
     for ip in ip_addresses:
-        geo_data = await prisma.models.GeolocationData.prisma().find_unique(
-            where={"ipAddress": ip}
-        )
-        if geo_data:
-            geolocations.append(
+        try:
+            addresses.append(ipaddress.ip_address(ip))
+        except ValueError:
+            invalid.append(ip)
+    if invalid:
+        raise HTTPException(status_code=422, detail={"invalid_ip_addresses": invalid})
+    normalized = [str(address) for address in addresses]
+    table = project.geolocation_table.table
+    if table is not None:
+        rows_by_ip = dict(zip(normalized, table.lookup_many(addresses)))
+    else:
+        rows_by_ip = await _fetch_rows({*normalized})
+    found = [
+        (ip, row)
+        for ip, key in zip(ip_addresses, normalized)
+        if (row := rows_by_ip[key])
+    ]
+    if format == "aos":
+        return BulkGeolocationQueryResponse(
+            geolocation_data=[
                 GeolocationInfo(
                     ip_address=ip,
-                    country=geo_data.country,
-                    city=geo_data.city,
-                    latitude=geo_data.latitude,
-                    longitude=geo_data.longitude,
-                    ISP=geo_data.ISP,
+                    country=row[0],
+                    city=row[1],
+                    latitude=row[2],
+                    longitude=row[3],
+                    ISP=row[4],
                 )
-            )
-        else:
-            continue
-    return BulkGeolocationQueryResponse(geolocation_data=geolocations)
+                for ip, row in found
+            ]
+        )
+    # Columnar layouts name each field once instead of once per address.
+    columns = {
+        "ip_address": [ip for ip, _ in found],
+        "country": [row[0] for _, row in found],
+        "city": [row[1] for _, row in found],
+        "latitude": [row[2] for _, row in found],
+        "longitude": [row[3] for _, row in found],
+        "ISP": [row[4] for _, row in found],
+    }
+    if format == "arrow":
+        return _arrow_response(columns)
+    return ORJSONResponse(columns)
@@ -1,10 +1,15 @@
-import uuid
+import secrets
 from datetime import datetime
 
 import prisma
+import prisma.errors
 import prisma.models
+import project.ratelimit
 from pydantic import BaseModel
 
+# Number of attempts made before giving up on generating a unique API key.
+MAX_KEY_ATTEMPTS = 3
+
 
 class CreateApiKeyResponse(BaseModel):
     """
@@ -22,7 +27,8 @@ async def create_api_key(user_id: str) -> CreateApiKeyResponse:
 
     This function generates a unique API key for a user based on their user_id. It stores this API key in the database
     within the APIKey model linked to the User model by the user's ID. The function ensures that the generated API key
-    is unique and retries if a collision occurs. It finally returns the API key details in a CreateApiKeyResponse model.
+    is unique and retries a bounded number of times if a collision occurs. It finally returns the API key details in a
+    CreateApiKeyResponse model.
 
     Args:
     user_id (str): The unique identifier of the user requesting a new API key. This could be validated against the
@@ -32,17 +38,17 @@ async def create_api_key(user_id: str) -> CreateApiKeyResponse:
     CreateApiKeyResponse: Contains the details of the newly created API key for the user, including the API key,
     creation date, and status of creation.
     """
-    api_key = uuid.uuid4().hex
-    creation_date = datetime.now()
-    retry = True
-    while retry:
+    for attempt in range(MAX_KEY_ATTEMPTS):
+        api_key = secrets.token_urlsafe(32)
         try:
-            await prisma.models.APIKey.prisma().create(
+            record = await prisma.models.APIKey.prisma().create(
                 data={"key": api_key, "userId": user_id}
             )
-            retry = False
-        except Exception as e:
-            api_key = uuid.uuid4().hex
+            break
+        except prisma.errors.UniqueViolationError:
+            if attempt == MAX_KEY_ATTEMPTS - 1:
+                raise
+    await project.ratelimit.store_api_key(record.key, record.userId)
     return CreateApiKeyResponse(
-        api_key=api_key, creation_date=creation_date, status="Success"
+        api_key=record.key, creation_date=record.createdAt, status="Success"
     )
@@ -0,0 +1,53 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+# (country, city, latitude, longitude, ISP) as stored on GeolocationData. Plain
+# tuples are cached instead of Pydantic models since they are cheaper to keep around.
+GeolocationRow = Tuple[
+    Optional[str], Optional[str], Optional[float], Optional[float], Optional[str]
+]
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Least-recently-used cache whose entries expire a fixed number of seconds after being set.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """
+        Returns the cached value for key, or default if it is absent or expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Stores value under key, evicting the least recently used entry when full.
+        """
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+# Per-process cache of geolocation lookups keyed on IP address. A cached value of
+# None records that the IP address has no geolocation data.
+geolocation_cache = TTLCache(maxsize=100_000, ttl=600)
@@ -0,0 +1,362 @@
+import asyncio
+import fcntl
+import ipaddress
+import logging
+import math
+import mmap
+import os
+import struct
+from typing import Dict, Iterable, List, Optional, TextIO, Tuple, Union
+
+import asyncpg
+import numpy as np
+from project.geolocation_cache import GeolocationRow
+
+logger = logging.getLogger(__name__)
+
+IPAddress = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+
+# (network, country, city, latitude, longitude, ISP) as read from GeolocationData.
+TableRecord = Tuple[
+    str, Optional[str], Optional[str], Optional[float], Optional[float], Optional[str]
+]
+
+# Keys are the address prefixed with a family bit, so IPv4 and IPv6 sort into
+# separate halves of one key space and a block never contains an address of the
+# other family, as with inet containment in Postgres.
+_IPV6_FAMILY = 1 << 128
+_KEY_BYTES = 17
+_KEY_DTYPE = f"S{_KEY_BYTES}"
+
+TABLE_QUERY = (
+    'SELECT "ipAddress"::text, country, city, latitude, longitude, "ISP" '
+    'FROM "GeolocationData"'
+)
+
+
+def address_key(address: IPAddress) -> int:
+    """
+    Maps an IPv4 or IPv6 address onto the table's key space.
+    """
+    if address.version == 6:
+        return _IPV6_FAMILY | int(address)
+    return int(address)
+
+
+def _network_range(network: str) -> Tuple[int, int]:
+    parsed = ipaddress.ip_network(network, strict=False)
+    return (
+        address_key(parsed.network_address),
+        address_key(parsed.broadcast_address),
+    )
+
+
+# Header of a packed table: magic, range count, string count and string heap size.
+_HEADER = struct.Struct("<8sQQQ")
+_MAGIC = b"GEOTBL02"
+
+# String index of a NULL column value.
+_NULL_STRING = 0xFFFFFFFF
+
+
+def _layout(ranges: int, strings: int, heap_size: int) -> List[Tuple[str, str, int]]:
+    # Columns in file order as (name, dtype, length). Range bounds are 17-byte
+    # big-endian keys, so they sort as bytes the way the keys sort as integers.
+    return [
+        ("latitude", "<f8", ranges),
+        ("longitude", "<f8", ranges),
+        ("country", "<u4", ranges),
+        ("city", "<u4", ranges),
+        ("isp", "<u4", ranges),
+        ("string_offsets", "<u4", strings + 1),
+        ("starts", _KEY_DTYPE, ranges),
+        ("ends", _KEY_DTYPE, ranges),
+        ("string_heap", "u1", heap_size),
+    ]
+
+
+class GeolocationTable:
+    """
+    Read-only copy of GeolocationData answering lookups without a database round-trip.
+
+    Network blocks are flattened into sorted, disjoint key ranges where the most specific block wins, so a lookup
+    is a single binary search. Columns are NumPy views over one packed buffer, which is either built in memory or
+    mapped from a file so that all workers on a host share the same pages.
+    """
+
+    def __init__(self, buffer: Union[bytes, mmap.mmap], mtime_ns: int = 0) -> None:
+        magic, ranges, strings, heap_size = _HEADER.unpack_from(buffer)
+        if magic != _MAGIC:
+            raise ValueError("Not a packed geolocation table")
+        self.mtime_ns = mtime_ns
+        offset = _HEADER.size
+        for name, dtype, length in _layout(ranges, strings, heap_size):
+            column = np.frombuffer(buffer, dtype=dtype, count=length, offset=offset)
+            setattr(self, name, column)
+            offset += column.nbytes
+
+    @staticmethod
+    def pack(records: Iterable[TableRecord]) -> bytes:
+        """
+        Packs GeolocationData records into the binary layout read by GeolocationTable.
+        """
+        blocks = sorted(
+            ((*_network_range(network), tuple(row)) for network, *row in records),
+            key=lambda block: (block[0], -block[1]),
+        )
+        starts: List[int] = []
+        ends: List[int] = []
+        rows: List[GeolocationRow] = []
+
+        def emit(start: int, end: int, row: GeolocationRow) -> None:
+            if start <= end:
+                starts.append(start)
+                ends.append(end)
+                rows.append(row)
+
+        # CIDR blocks are either disjoint or nested. The stack holds the blocks
+        # enclosing the current position, innermost last, and position is the
+        # first key not yet emitted for the innermost one.
+        stack: List[Tuple[int, GeolocationRow]] = []
+        position = 0
+        for start, end, row in blocks:
+            while stack and stack[-1][0] < start:
+                enclosing_end, enclosing_row = stack.pop()
+                emit(position, enclosing_end, enclosing_row)
+                position = enclosing_end + 1
+            if stack:
+                emit(position, start - 1, stack[-1][1])
+            stack.append((end, row))
+            position = start
+        while stack:
+            enclosing_end, enclosing_row = stack.pop()
+            emit(position, enclosing_end, enclosing_row)
+            position = enclosing_end + 1
+
+        # Country, city and ISP names repeat across ranges and are stored once.
+        string_ids: Dict[str, int] = {}
+
+        def intern(value: Optional[str]) -> int:
+            if value is None:
+                return _NULL_STRING
+            return string_ids.setdefault(value, len(string_ids))
+
+        country, city, isp = (
+            [intern(row[column]) for row in rows] for column in (0, 1, 4)
+        )
+        encoded = [value.encode() for value in string_ids]
+        string_offsets = np.cumsum([0, *map(len, encoded)], dtype="<u4")
+        columns = {
+            "latitude": [np.nan if row[2] is None else row[2] for row in rows],
+            "longitude": [np.nan if row[3] is None else row[3] for row in rows],
+            "starts": [key.to_bytes(_KEY_BYTES, "big") for key in starts],
+            "ends": [key.to_bytes(_KEY_BYTES, "big") for key in ends],
+            "country": country,
+            "city": city,
+            "isp": isp,
+            "string_offsets": string_offsets,
+            "string_heap": np.frombuffer(b"".join(encoded), dtype="u1"),
+        }
+        layout = _layout(len(rows), len(encoded), int(string_offsets[-1]))
+        return _HEADER.pack(
+            _MAGIC, len(rows), len(encoded), int(string_offsets[-1])
+        ) + b"".join(
+            np.asarray(columns[name], dtype=dtype).tobytes()
+            for name, dtype, _ in layout
+        )
+
+    @classmethod
+    def build(cls, records: Iterable[TableRecord]) -> "GeolocationTable":
+        """
+        Builds a table in memory from GeolocationData records.
+        """
+        return cls(cls.pack(records))
+
+    @classmethod
+    def open(cls, path: str) -> "GeolocationTable":
+        """
+        Maps a table packed to a file read-only, so its pages are shared by every process mapping it.
+        """
+        with open(path, "rb") as file:
+            mtime_ns = os.fstat(file.fileno()).st_mtime_ns
+            buffer = mmap.mmap(file.fileno(), 0, prot=mmap.PROT_READ)
+        return cls(buffer, mtime_ns)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def _string(self, index: int) -> Optional[str]:
+        if index == _NULL_STRING:
+            return None
+        start, end = self.string_offsets[index : index + 2]
+        return self.string_heap[start:end].tobytes().decode()
+
+    def _float(self, value: float) -> Optional[float]:
+        return None if math.isnan(value) else float(value)
+
+    def _floats(self, values: np.ndarray) -> List[Optional[float]]:
+        return [None if math.isnan(value) else value for value in values.tolist()]
+
+    def lookup(self, address: IPAddress) -> Optional[GeolocationRow]:
+        """
+        Returns the row of the most specific block containing the address, or None.
+        """
+        # NumPy drops trailing NUL bytes from the elements it returns, so the key is
+        # compared in the same form. Stripping them keeps the order of equal-width keys.
+        key = address_key(address).to_bytes(_KEY_BYTES, "big").rstrip(b"\0")
+        i = int(np.searchsorted(self.starts, key, side="right")) - 1
+        if i < 0 or key > self.ends[i]:
+            return None
+        return (
+            self._string(self.country[i]),
+            self._string(self.city[i]),
+            self._float(self.latitude[i]),
+            self._float(self.longitude[i]),
+            self._string(self.isp[i]),
+        )
+
+    def lookup_many(self, addresses: List[IPAddress]) -> List[Optional[GeolocationRow]]:
+        """
+        Looks up many addresses at once, with the search and range checks done by NumPy over whole arrays.
+
+        Returns:
+        List[Optional[GeolocationRow]]: The row of each address in order, or None where no block contains it.
+        """
+        keys = np.array(
+            [address_key(address).to_bytes(_KEY_BYTES, "big") for address in addresses],
+            dtype=_KEY_DTYPE,
+        )
+        indices = np.searchsorted(self.starts, keys, side="right") - 1
+        found = indices >= 0
+        found[found] = keys[found] <= self.ends[indices[found]]
+        hits = np.flatnonzero(found)
+        matched = indices[hits]
+        rows: List[Optional[GeolocationRow]] = [None] * len(addresses)
+        columns = zip(
+            map(self._string, self.country[matched].tolist()),
+            map(self._string, self.city[matched].tolist()),
+            self._floats(self.latitude[matched]),
+            self._floats(self.longitude[matched]),
+            map(self._string, self.isp[matched].tolist()),
+        )
+        for position, row in zip(hits.tolist(), columns):
+            rows[position] = row
+        return rows
+
+
+# The table currently served by this worker, or None while lookups go to the database.
+table: Optional[GeolocationTable] = None
+
+
+async def load(pool: asyncpg.Pool) -> GeolocationTable:
+    """
+    Reads GeolocationData into a new table and makes it the one served.
+    """
+    global table
+    records = await pool.fetch(TABLE_QUERY)
+    # Built off the event loop thread so requests keep being served meanwhile.
+    table = await asyncio.to_thread(GeolocationTable.build, records)
+    logger.info("Loaded %d geolocation ranges", len(table))
+    return table
+
+
+def load_file(path: str) -> GeolocationTable:
+    """
+    Maps a table packed by pack_file and makes it the one served.
+    """
+    global table
+    table = GeolocationTable.open(path)
+    logger.info("Mapped %d geolocation ranges from %s", len(table), path)
+    return table
+
+
+async def pack_file(source: Union[asyncpg.Pool, asyncpg.Connection], path: str) -> None:
+    """
+    Reads GeolocationData and packs it to a file for workers to map with load_file.
+
+    The file is replaced atomically, so workers mapping the previous one keep a consistent view.
+    """
+    records = await source.fetch(TABLE_QUERY)
+    packed = await asyncio.to_thread(GeolocationTable.pack, records)
+    partial = f"{path}.{os.getpid()}.tmp"
+    with open(partial, "wb") as file:
+        file.write(packed)
+    os.replace(partial, path)
+
+
+async def pack_database(dsn: str, path: str) -> None:
+    """
+    Packs GeolocationData to a file over a connection of its own, for use outside the server's workers.
+    """
+    connection = await asyncpg.connect(dsn)
+    try:
+        await pack_file(connection, path)
+    finally:
+        await connection.close()
+
+
+# Lock file held for its lifetime by the one process repacking a shared table file.
+_packer_lock: Optional[TextIO] = None
+
+
+def _is_packer(path: str) -> bool:
+    global _packer_lock
+    if _packer_lock is None:
+        lock = open(f"{path}.lock", "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return False
+        _packer_lock = lock
+    return True
+
+
+async def load_shared(pool: asyncpg.Pool, path: str) -> GeolocationTable:
+    """
+    Serves the table packed to path, shared with the other workers mapping it.
+
+    One worker takes the packer role and packs the file if it is missing. Until it exists, the table is built in
+    memory instead and the worker switches to the file on a later refresh.
+    """
+    if _is_packer(path) and not os.path.exists(path):
+        await pack_file(pool, path)
+    if os.path.exists(path):
+        return load_file(path)
+    logger.warning("%s not packed yet, loading the geolocation table in memory", path)
+    return await load(pool)
+
+
+async def run_refresher(
+    pool: asyncpg.Pool, interval: float, path: Optional[str] = None
+) -> None:
+    """
+    Reloads the table every interval seconds until cancelled.
+
+    For a table shared through a file, the packer repacks the file and every worker remaps it once replaced.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if path is None:
+                await load(pool)
+                continue
+            if _is_packer(path):
+                await pack_file(pool, path)
+            if (
+                table is None
+                or not os.path.exists(path)
+                or os.stat(path).st_mtime_ns != table.mtime_ns
+            ):
+                await load_shared(pool, path)
+        except Exception:
+            logger.exception("Error refreshing geolocation table")
+
+
+if __name__ == "__main__":
+    import sys
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    asyncio.run(pack_database(os.environ["DATABASE_URL"], sys.argv[1]))
@@ -1,10 +1,42 @@
-from typing import Optional
+import asyncio
+import ipaddress
+from typing import Dict, Optional
 
-import prisma
-import prisma.models
+import asyncpg
+import project.geolocation_table
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
+from project.geolocation_cache import MISSING, GeolocationRow, geolocation_cache
 from pydantic import BaseModel
 
+# The hottest query in the service, run through asyncpg rather than the Prisma
+# engine. asyncpg prepares it once per connection and reuses the statement. The
+# most specific network block containing the address wins.
+GEOLOCATION_QUERY = (
+    'SELECT country, city, latitude, longitude, "ISP" FROM "GeolocationData" '
+    'WHERE "ipAddress" >>= $1::inet ORDER BY masklen("ipAddress") DESC LIMIT 1'
+)
+
+
+_pool: Optional[asyncpg.Pool] = None
+
+
+async def connect_pool(dsn: str, min_size: int, max_size: int) -> asyncpg.Pool:
+    """
+    Opens the asyncpg connection pool used for geolocation lookups.
+
+    The DSN must reach Postgres directly: PgBouncer in transaction mode can't keep
+    prepared statements on a server connection.
+    """
+    global _pool
+    _pool = await asyncpg.create_pool(dsn, min_size=min_size, max_size=max_size)
+    return _pool
+
+
+async def close_pool() -> None:
+    if _pool is not None:
+        await _pool.close()
+
 
 class GeolocationDataResponse(BaseModel):
     """
@@ -18,38 +50,76 @@ class GeolocationDataResponse(BaseModel):
     ISP: Optional[str] = None
 
 
+# Database lookups in progress, keyed on IP address. Concurrent cache misses for
+# the same address await the one query instead of each running their own.
+_inflight: Dict[str, "asyncio.Task[Optional[GeolocationRow]]"] = {}
+
+
+async def _query(ip_address: str) -> Optional[GeolocationRow]:
+    record = await _pool.fetchrow(GEOLOCATION_QUERY, ip_address)
+    row = tuple(record) if record else None
+    geolocation_cache.set(ip_address, row)
+    return row
+
+
+async def _fetch(ip_address: str) -> Optional[GeolocationRow]:
+    """
+    Looks up the geolocation row for an IP address, consulting the in-process cache first.
+    """
+    row = geolocation_cache.get(ip_address)
+    if row is not MISSING:
+        return row
+    task = _inflight.get(ip_address)
+    if task is None:
+        task = _inflight[ip_address] = asyncio.create_task(_query(ip_address))
+        task.add_done_callback(lambda _: _inflight.pop(ip_address, None))
+    # Shielded so a cancelled request doesn't cancel the query for the others.
+    return await asyncio.shield(task)
+
+
 app = FastAPI()
 
 
 @app.get("/geolocation/{ip_address}", response_model=GeolocationDataResponse)
-async def get_geolocation_data(ip_address: str) -> GeolocationDataResponse:
+async def get_geolocation_data(ip_address: str) -> ORJSONResponse:
     """
     Retrieves geolocation data for a given IP address.
 
-    This function queries the database for the geolocation information associated
-    with the specified IP address. If the information is found, it is returned as
-    a response model. Otherwise, an HTTP exception is raised indicating that the
+    This function looks up the geolocation information associated with the specified
+    IP address in the preloaded table, or queries the database if none is loaded. If
+    the information is found, it is returned as a JSON response shaped like
+    GeolocationDataResponse. Otherwise, an HTTP exception is raised indicating that the
     data could not be found.
 
     Args:
     ip_address (str): The IP address (IPv4 or IPv6 format) for which geolocation data is being requested.
 
     Returns:
-    GeolocationDataResponse: Response model containing detailed geolocation information for a given IP address.
+    ORJSONResponse: JSON response containing detailed geolocation information for a given IP address.
 
     Raises:
-    HTTPException: If no geolocation data are found for the given IP address.
-    """
-    geolocation_data = await prisma.models.GeolocationData.prisma().find_unique(
-        where={"ipAddress": ip_address}
-    )
-    if geolocation_data:
-        return GeolocationDataResponse(
-            country=geolocation_data.country,
-            city=geolocation_data.city,
-            latitude=geolocation_data.latitude,
-            longitude=geolocation_data.longitude,
-            ISP=geolocation_data.ISP,
+    HTTPException: If the IP address is malformed, or no geolocation data are found for it.
+    """
+    try:
+        address = ipaddress.ip_address(ip_address)
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"Invalid IP address: {ip_address}")
+    ip_address = str(address)
+    table = project.geolocation_table.table
+    if table is not None:
+        row = table.lookup(address)
+    else:
+        row = await _fetch(ip_address)
+    if row:
+        country, city, latitude, longitude, ISP = row
+        return ORJSONResponse(
+            {
+                "country": country,
+                "city": city,
+                "latitude": latitude,
+                "longitude": longitude,
+                "ISP": ISP,
+            }
         )
     else:
         raise HTTPException(
@@ -1,9 +1,25 @@
+import asyncio
+import time
 from datetime import datetime
 
-import prisma
-import prisma.models
+import project.ratelimit
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
+# Timestamp reported for users without rate limit settings, refreshed once a
+# second by refresh_now_cache rather than read from the clock per request.
+_now_cache: datetime = datetime.now()
+
+
+async def refresh_now_cache() -> None:
+    """
+    Updates the cached timestamp every second until cancelled.
+    """
+    global _now_cache
+    while True:
+        await asyncio.sleep(1)
+        _now_cache = datetime.now()
+
 
 class GetUserRateLimitResponse(BaseModel):
     """
@@ -13,39 +29,59 @@ class GetUserRateLimitResponse(BaseModel):
     user_id: str
     limit: int
     windowSec: int
+    remaining: int
     createdAt: datetime
     updatedAt: datetime
 
 
-async def get_user_rate_limit(user_id: str) -> GetUserRateLimitResponse:
+async def get_user_rate_limit(user_id: str) -> ORJSONResponse:
     """
     Retrieves the current rate limit settings for a specific user or API key.
 
-    This function queries the 'prisma.models.RateLimit' table to find the rate limit settings associated with the given user_id.
-    If no settings are found, it returns a default rate limit response.
+    This function reads the rate limit settings and token bucket associated with the given user_id from Redis, which
+    mirrors the 'prisma.models.RateLimit' table. If no settings are found, it returns a default rate limit response.
 
     Args:
         user_id (str): Unique identifier for the user or API key to retrieve rate limit settings for.
 
     Returns:
-    GetUserRateLimitResponse: Response model containing the retrieved rate limit settings for the user or API key.
+    ORJSONResponse: JSON response shaped like GetUserRateLimitResponse, containing the retrieved rate limit settings
+    for the user or API key.
     """
-    rate_limit = await prisma.models.RateLimit.prisma().find_unique(
-        where={"key": user_id}
-    )
-    if rate_limit:
-        return GetUserRateLimitResponse(
-            user_id=user_id,
-            limit=rate_limit.limit,
-            windowSec=rate_limit.windowSec,
-            createdAt=rate_limit.createdAt,
-            updatedAt=rate_limit.updatedAt,
+    config, bucket = await project.ratelimit.get_state(user_id)
+    remaining = project.ratelimit.local_remaining(user_id)
+    if config:
+        limit = int(config["limit"])
+        windowSec = int(config["windowSec"])
+        if remaining is None:
+            remaining = project.ratelimit.remaining_tokens(
+                bucket, limit, windowSec, time.time()
+            )
+        return ORJSONResponse(
+            {
+                "user_id": user_id,
+                "limit": limit,
+                "windowSec": windowSec,
+                "remaining": remaining,
+                "createdAt": config["createdAt"],
+                "updatedAt": config["updatedAt"],
+            }
         )
     else:
-        return GetUserRateLimitResponse(
-            user_id=user_id,
-            limit=100,
-            windowSec=3600,
-            createdAt=datetime.now(),
-            updatedAt=datetime.now(),
+        if remaining is None:
+            remaining = project.ratelimit.remaining_tokens(
+                bucket,
+                project.ratelimit.DEFAULT_LIMIT,
+                project.ratelimit.DEFAULT_WINDOW_SEC,
+                time.time(),
+            )
+        return ORJSONResponse(
+            {
+                "user_id": user_id,
+                "limit": project.ratelimit.DEFAULT_LIMIT,
+                "windowSec": project.ratelimit.DEFAULT_WINDOW_SEC,
+                "remaining": remaining,
+                "createdAt": _now_cache,
+                "updatedAt": _now_cache,
+            }
         )
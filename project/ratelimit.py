@@ -0,0 +1,424 @@
+import asyncio
+import logging
+import math
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+import prisma
+import prisma.models
+import redis.asyncio as redis
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from project.geolocation_cache import MISSING, TTLCache
+from redis.commands.core import AsyncScript
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 100
+DEFAULT_WINDOW_SEC = 3600
+
+# Paths whose requests are counted against the caller's rate limit.
+RATE_LIMITED_PREFIXES = ("/geolocation",)
+
+# How often the background task looks for local buckets due to be flushed. Each
+# bucket is flushed once a tenth of its window has passed since its last flush.
+FLUSH_TICK_SEC = 1.0
+
+# How often rate limit settings and API keys are copied from Postgres into Redis
+# again, restoring them after Redis restarts or evicts them.
+SYNC_INTERVAL_SEC = 60.0
+
+# Refills the bucket for the time elapsed since the last call and takes ARGV[2]
+# tokens from it if enough are available, or empties it when ARGV[5] is '1' and
+# there aren't (used to report tokens already spent locally). Limits are read
+# from the config hash so the whole check is a single round-trip.
+#
+# KEYS[1]: bucket hash {tokens, last_refill}
+# KEYS[2]: config hash {limit, windowSec, createdAt, updatedAt}
+# ARGV: now (seconds), tokens to take, default limit, default window, force
+# Returns: {allowed, remaining tokens, limit, window}
+TOKEN_BUCKET_SCRIPT = """
+local config = redis.call('HMGET', KEYS[2], 'limit', 'windowSec')
+local capacity = tonumber(config[1]) or tonumber(ARGV[3])
+local window = math.max(1, tonumber(config[2]) or tonumber(ARGV[4]))
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'last_refill')
+local tokens = tonumber(bucket[1]) or capacity
+local last_refill = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - last_refill) * capacity / window)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+elseif ARGV[5] == '1' then
+    tokens = 0
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'last_refill', now)
+redis.call('EXPIRE', KEYS[1], window)
+return {allowed, math.floor(tokens), capacity, window}
+"""
+
+redis_client: Optional[redis.Redis] = None
+_token_bucket: Optional[AsyncScript] = None
+
+
+class LocalBucket:
+    """
+    Per-worker copy of a token bucket, spent without coordination and periodically reconciled with Redis.
+    """
+
+    __slots__ = (
+        "tokens",
+        "last_refill",
+        "limit",
+        "windowSec",
+        "pending",
+        "flushed_at",
+        "touched",
+    )
+
+    def __init__(self, tokens: float, limit: int, windowSec: int, now: float) -> None:
+        self.tokens = tokens
+        self.last_refill = now
+        self.limit = limit
+        self.windowSec = windowSec
+        self.pending = 0
+        self.flushed_at = now
+        self.touched = True
+
+    def refill(self, now: float) -> None:
+        elapsed = max(0.0, now - self.last_refill)
+        self.tokens = min(
+            self.limit, self.tokens + elapsed * self.limit / self.windowSec
+        )
+        self.last_refill = now
+
+
+# Local buckets of this worker, keyed on user or client address.
+_local_buckets: Dict[str, LocalBucket] = {}
+
+# Redis hash mapping every active API key to the user owning it, so callers are
+# identified without a Postgres query. Filled by sync_api_keys and store_api_key.
+API_KEYS_KEY = "ratelimit:apikeys"
+
+# Owners of API keys sent in X-API-Key, or None for unknown keys. Bounded, so keys
+# made up to dodge the limit can't grow it without limit either.
+_api_key_cache = TTLCache(maxsize=10_000, ttl=60)
+
+
+def bucket_key(user_id: str) -> str:
+    # The hash tag keeps both keys of a user in the same slot on Redis Cluster.
+    return f"ratelimit:{{{user_id}}}:bucket"
+
+
+def config_key(user_id: str) -> str:
+    return f"ratelimit:{{{user_id}}}:config"
+
+
+async def connect(url: str) -> None:
+    """
+    Connects to Redis and registers the token bucket script, which is sent with SCRIPT LOAD
+    on first use and invoked through EVALSHA afterwards.
+    """
+    global redis_client, _token_bucket
+    # Timeouts bound how long a request waits on an unreachable Redis before the
+    # rate limiter falls back to local buckets.
+    redis_client = redis.Redis.from_url(
+        url, decode_responses=True, socket_connect_timeout=1.0, socket_timeout=1.0
+    )
+    _token_bucket = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+    await redis_client.ping()
+
+
+async def disconnect() -> None:
+    if redis_client is not None:
+        await redis_client.close()
+
+
+def _config_mapping(
+    limit: int, windowSec: int, createdAt: datetime, updatedAt: datetime
+) -> Dict[str, object]:
+    return {
+        "limit": limit,
+        "windowSec": windowSec,
+        "createdAt": createdAt.isoformat(),
+        "updatedAt": updatedAt.isoformat(),
+    }
+
+
+async def store_limit(
+    user_id: str,
+    limit: int,
+    windowSec: int,
+    createdAt: datetime,
+    updatedAt: datetime,
+) -> None:
+    """
+    Writes the rate limit settings of a user or API key to Redis.
+    """
+    await redis_client.hset(
+        config_key(user_id),
+        mapping=_config_mapping(limit, windowSec, createdAt, updatedAt),
+    )
+
+
+async def sync_limits() -> None:
+    """
+    Copies every RateLimit row from Postgres into Redis, which serves all rate limit reads.
+    """
+    rate_limits = await prisma.models.RateLimit.prisma().find_many()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for rate_limit in rate_limits:
+            pipe.hset(
+                config_key(rate_limit.key),
+                mapping=_config_mapping(
+                    rate_limit.limit,
+                    rate_limit.windowSec,
+                    rate_limit.createdAt,
+                    rate_limit.updatedAt,
+                ),
+            )
+        await pipe.execute()
+
+
+async def store_api_key(api_key: str, user_id: str) -> None:
+    """
+    Records a newly created API key as belonging to a user.
+    """
+    await redis_client.hset(API_KEYS_KEY, api_key, user_id)
+
+
+async def sync_api_keys() -> None:
+    """
+    Replaces the API keys known to Redis with the active APIKey rows in Postgres.
+    """
+    api_keys = await prisma.models.APIKey.prisma().find_many(where={"active": True})
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(API_KEYS_KEY)
+        if api_keys:
+            pipe.hset(
+                API_KEYS_KEY,
+                mapping={api_key.key: api_key.userId for api_key in api_keys},
+            )
+        await pipe.execute()
+
+
+async def get_state(user_id: str) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Reads the config and bucket hashes of a user or API key in a single round-trip.
+    """
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(config_key(user_id))
+        pipe.hgetall(bucket_key(user_id))
+        config, bucket = await pipe.execute()
+    return config, bucket
+
+
+def remaining_tokens(
+    bucket: Dict[str, str], limit: int, windowSec: int, now: float
+) -> int:
+    """
+    Computes the tokens currently available in a bucket, accounting for refill since it was last written.
+    """
+    if not bucket:
+        return limit
+    tokens = float(bucket["tokens"])
+    elapsed = max(0.0, now - float(bucket["last_refill"]))
+    return math.floor(min(limit, tokens + elapsed * limit / max(1, windowSec)))
+
+
+async def take_token(
+    user_id: str, cost: int = 1, force: bool = False
+) -> Tuple[bool, int, int, int]:
+    """
+    Atomically takes tokens from the Redis bucket of a user or API key.
+
+    Args:
+    user_id (str): The user or API key whose bucket is charged.
+    cost (int): The number of tokens to take.
+    force (bool): Whether to empty the bucket when it holds fewer than cost tokens, for requests already served.
+
+    Returns:
+    Tuple[bool, int, int, int]: Whether the tokens were taken, the tokens left, the limit and the window in seconds.
+    """
+    allowed, remaining, limit, window = await _token_bucket(
+        keys=[bucket_key(user_id), config_key(user_id)],
+        args=[time.time(), cost, DEFAULT_LIMIT, DEFAULT_WINDOW_SEC, int(force)],
+    )
+    return bool(allowed), remaining, limit, window
+
+
+async def allow_request(user_id: str) -> Tuple[bool, int, int]:
+    """
+    Takes one token for a request, from this worker's copy of the bucket once it has one.
+
+    The first request of a caller is checked against Redis exactly and seeds the local bucket. Later ones are
+    decided locally and counted as pending until the next flush, so a caller can exceed their limit by at most
+    what the other workers let through between flushes.
+
+    Returns:
+    Tuple[bool, int, int]: Whether the request is allowed, the limit and the window in seconds.
+    """
+    now = time.time()
+    bucket = _local_buckets.get(user_id)
+    if bucket is None:
+        try:
+            allowed, remaining, limit, window = await take_token(user_id)
+        except redis.RedisError:
+            # Lookups shouldn't fail with the rate limiter, so the caller starts on a
+            # local bucket at the default limit, reconciled once Redis is back.
+            logger.warning("Rate limiting %s locally", user_id, exc_info=True)
+            bucket = LocalBucket(DEFAULT_LIMIT, DEFAULT_LIMIT, DEFAULT_WINDOW_SEC, now)
+            _local_buckets[user_id] = bucket
+        else:
+            _local_buckets[user_id] = LocalBucket(remaining, limit, window, now)
+            return allowed, limit, window
+    bucket.refill(now)
+    bucket.touched = True
+    if bucket.tokens < 1:
+        return False, bucket.limit, bucket.windowSec
+    bucket.tokens -= 1
+    bucket.pending += 1
+    return True, bucket.limit, bucket.windowSec
+
+
+def local_remaining(user_id: str) -> Optional[int]:
+    """
+    Returns the tokens left in this worker's copy of a bucket, or None if the caller hasn't been seen here.
+    """
+    bucket = _local_buckets.get(user_id)
+    if bucket is None:
+        return None
+    bucket.refill(time.time())
+    return max(0, math.floor(bucket.tokens))
+
+
+async def _flush_bucket(user_id: str, bucket: LocalBucket) -> None:
+    sent, bucket.pending = bucket.pending, 0
+    bucket.touched = False
+    try:
+        _, remaining, limit, window = await take_token(user_id, sent, force=True)
+    except Exception:
+        bucket.pending += sent
+        raise
+    now = time.time()
+    # Requests served while the flush was in flight are still pending locally.
+    bucket.tokens = max(0, remaining - bucket.pending)
+    bucket.last_refill = now
+    bucket.limit = limit
+    bucket.windowSec = window
+    bucket.flushed_at = now
+
+
+async def flush_local_buckets(all_buckets: bool = False) -> None:
+    """
+    Reports tokens spent locally to Redis and refreshes local buckets with the global count.
+
+    Buckets that saw no requests since their previous flush are dropped instead.
+
+    Args:
+    all_buckets (bool): Whether to flush every bucket rather than only those due, as done on shutdown.
+    """
+    now = time.time()
+    due = {}
+    for user_id, bucket in list(_local_buckets.items()):
+        if not all_buckets and now - bucket.flushed_at < bucket.windowSec / 10:
+            continue
+        if not bucket.touched and not bucket.pending:
+            del _local_buckets[user_id]
+            continue
+        due[user_id] = bucket
+    results = await asyncio.gather(
+        *(_flush_bucket(user_id, bucket) for user_id, bucket in due.items()),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Error flushing rate limit bucket", exc_info=result)
+
+
+async def run_flusher() -> None:
+    """
+    Flushes local buckets every FLUSH_TICK_SEC until cancelled.
+    """
+    while True:
+        await asyncio.sleep(FLUSH_TICK_SEC)
+        try:
+            await flush_local_buckets()
+        except Exception:
+            logger.exception("Error flushing rate limit buckets")
+
+
+async def run_syncer() -> None:
+    """
+    Copies rate limit settings and API keys into Redis every SYNC_INTERVAL_SEC until cancelled.
+    """
+    while True:
+        await asyncio.sleep(SYNC_INTERVAL_SEC)
+        try:
+            await sync_limits()
+            await sync_api_keys()
+        except Exception:
+            logger.exception("Error syncing rate limit settings")
+
+
+async def api_key_owner(api_key: str) -> Optional[str]:
+    """
+    Returns the user owning an active API key, or None if the key is unknown or inactive.
+    """
+    user_id = _api_key_cache.get(api_key)
+    if user_id is MISSING:
+        try:
+            user_id = await redis_client.hget(API_KEYS_KEY, api_key)
+        except redis.RedisError:
+            logger.warning("Error looking up API key owner", exc_info=True)
+            return None
+        _api_key_cache.set(api_key, user_id)
+    return user_id
+
+
+async def client_key(request: Request) -> str:
+    """
+    Identifies the caller by the user owning their API key, falling back to the client address.
+
+    API keys are checked against Redis only, so requests with made-up keys never reach Postgres.
+    """
+    api_key = request.headers.get("X-API-Key")
+    user_id = await api_key_owner(api_key) if api_key else None
+    if user_id:
+        return user_id
+    return request.client.host if request.client else "unknown"
+
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware rejecting rate limited requests with a 429 before they reach any route.
+
+    Allowed requests are handed to the app as they are, so their responses aren't re-streamed.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not scope["path"].startswith(
+            RATE_LIMITED_PREFIXES
+        ):
+            await self.app(scope, receive, send)
+            return
+        allowed, limit, window = await allow_request(await client_key(Request(scope)))
+        if not allowed:
+            response = JSONResponse(
+                {"detail": "Rate limit exceeded."},
+                status_code=429,
+                # A limit of 0 never refills, so the caller is told to wait out the window.
+                headers={
+                    "Retry-After": str(math.ceil(window / limit) if limit else window)
+                },
+            )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
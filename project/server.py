@@ -1,61 +1,176 @@
+import asyncio
 import logging
-from contextlib import asynccontextmanager
-from typing import List
+import os
+from typing import Any, Dict, List
 
 import project.bulk_geolocation_query_service
 import project.create_api_key_service
+import project.geolocation_table
 import project.get_geolocation_data_service
 import project.get_user_rate_limit_service
+import project.ratelimit
 import project.update_user_rate_limit_service
 import project.verify_api_key_service
-from fastapi import FastAPI
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.openapi.utils import get_openapi
+from fastapi.responses import ORJSONResponse, Response
+from fastapi.routing import APIRoute
 from prisma import Prisma
+from starlette.routing import Route
 
 logger = logging.getLogger(__name__)
 
-db_client = Prisma(auto_register=True)
+load_dotenv()
 
+# DATABASE_POOL_URL points the client at PgBouncer; DATABASE_URL stays a direct
+# connection so the Prisma CLI can push the schema.
+DB_URL = os.getenv("DATABASE_POOL_URL")
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    await db_client.connect()
-    yield
-    await db_client.disconnect()
+TABLE_PATH = os.getenv("GEOLOCATION_TABLE_PATH")
+
+# Worker processes, each opening its own asyncpg pool straight to Postgres. Uvicorn
+# reads the same variable, and `python -m project.server` sets it for its workers.
+# Without it this is a single process, e.g. under a plain `uvicorn` command.
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Direct connections shared by all workers' pools, kept well below max_connections
+# (100 by default) next to PgBouncer's own pool.
+PG_POOL_MAX_CONNECTIONS = int(os.getenv("PG_POOL_MAX_CONNECTIONS", "40"))
+PG_POOL_MAX_SIZE = max(1, PG_POOL_MAX_CONNECTIONS // WORKERS)
+PG_POOL_MIN_SIZE = min(int(os.getenv("PG_POOL_MIN_SIZE", "1")), PG_POOL_MAX_SIZE)
+
+db_client = Prisma(auto_register=True, datasource={"url": DB_URL} if DB_URL else None)
 
 
 app = FastAPI(
     title="aarushi-geo-location-1",
-    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     description="Based on the interview, the user requires an API endpoint designed with FastAPI that handles geolocation data retrieval based on IP addresses. The following key points were highlighted during the discussions:\n\n- The API should be asynchronous (async) to ensure scalability and handle the anticipated volume of up to 1000 requests per second. This aids in maintaining an efficient and responsive service.\n- Specific data to be retrieved from the geolocation database includes the country, city, latitude, longitude, and, ideally, the Internet Service Provider (ISP) information. These data points are essential for location-based services, content personalization, technical analytics, and assessing access rights.\n- Performance goals are set to achieve response times of less than 200 milliseconds, thereby ensuring a smooth user experience without noticeable delays.\n- The need to support bulk IP address queries was also emphasized. This feature will significantly lower the number of requests sent by clients requiring data for multiple IP addresses simultaneously, thus enhancing the overall performance.\n\nTo address these requirements, the following technical stack components were identified as suitable choices:\n- **Programming Language:** Python, for its simplicity and asynchronous capabilities.\n- **API Framework:** FastAPI, noted for its ease of use for creating asynchronous APIs, built-in OpenAPI support for comprehensive documentation, and its dependency injection system which contributes to cleaner, more maintainable code.\n- **Database:** PostgreSQL, due to its robustness and the capability to store and efficiently query geolocation data. Specific aspects such as using IP network data types (INET or CIDR) for accurate IP range queries and creating indexes on IP address columns for performance optimization were recommended.\n- **ORM:** Prisma, while it doesn't natively support PostgreSQL's geolocation data types such as 'point', can still be utilized by employing raw SQL queries or mapping these specific data types to string or binary fields and manually handling them within the application logic.\n\nIn terms of design and development best practices, the project will leverage asynchronous request handling, implement authentication and data validation (utilizing Pydantic models), and consider scalability from the outset to effectively manage the expected load. The database setup will include importing a suitable geolocation database into PostgreSQL, with regular updates to ensure data accuracy.",
 )
 
 
-@app.get(
-    "/geolocation/{ip_address}",
-    response_model=project.get_geolocation_data_service.GeolocationDataResponse,
-)
-async def api_get_get_geolocation_data(
-    ip_address: str,
-) -> project.get_geolocation_data_service.GeolocationDataResponse | Response:
-    """
-    Retrieves geolocation data for a given IP address.
-    """
-    try:
-        res = await project.get_geolocation_data_service.get_geolocation_data(
-            ip_address
+# Registered as startup and shutdown handlers: the locked FastAPI version predates the
+# lifespan argument and would silently ignore it.
+@app.on_event("startup")
+async def startup() -> None:
+    await db_client.connect()
+    # Open a pooled connection up front so the first request doesn't pay for the handshake.
+    await db_client.execute_raw("SELECT 1")
+    app.state.pg = await project.get_geolocation_data_service.connect_pool(
+        os.environ["DATABASE_URL"], PG_POOL_MIN_SIZE, PG_POOL_MAX_SIZE
+    )
+    # GEOLOCATION_PRELOAD=1 answers lookups from an in-memory copy of the table, which
+    # takes memory and startup time sized to the table, so lookups stay on the database
+    # unless it is set. With GEOLOCATION_TABLE_PATH set, workers map a packed table
+    # shared between them instead of each building its own.
+    app.state.background_tasks = []
+    if os.getenv("GEOLOCATION_PRELOAD", "0") == "1":
+        if TABLE_PATH:
+            await project.geolocation_table.load_shared(app.state.pg, TABLE_PATH)
+        else:
+            await project.geolocation_table.load(app.state.pg)
+        app.state.background_tasks.append(
+            asyncio.create_task(
+                project.geolocation_table.run_refresher(
+                    app.state.pg,
+                    float(os.getenv("GEOLOCATION_REFRESH_SEC", "600")),
+                    TABLE_PATH,
+                )
+            )
         )
-        return res
-    except Exception as e:
-        logger.exception("Error processing request")
-        res = dict()
-        res["error"] = str(e)
-        return Response(
-            content=jsonable_encoder(res),
-            status_code=500,
-            media_type="application/json",
+    await project.ratelimit.connect(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    await project.ratelimit.sync_limits()
+    await project.ratelimit.sync_api_keys()
+    app.state.background_tasks += [
+        asyncio.create_task(project.ratelimit.run_flusher()),
+        asyncio.create_task(project.ratelimit.run_syncer()),
+        asyncio.create_task(project.get_user_rate_limit_service.refresh_now_cache()),
+    ]
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    for task in app.state.background_tasks:
+        task.cancel()
+    await project.ratelimit.flush_local_buckets(all_buckets=True)
+    await project.ratelimit.disconnect()
+    await project.get_geolocation_data_service.close_pool()
+    await db_client.disconnect()
+
+
+# Only bulk responses are large enough to be worth compressing; single lookups
+# stay below minimum_size and are sent as-is. Rate limiting is added last so it
+# runs first and rejected requests skip compression.
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+app.add_middleware(project.ratelimit.RateLimitMiddleware)
+
+
+# Not logged here: Starlette re-raises the exception after sending this response,
+# and the server logs it then.
+@app.exception_handler(Exception)
+async def handle_unexpected_error(request: Request, exc: Exception) -> Response:
+    return ORJSONResponse({"error": str(exc)}, status_code=500)
+
+
+async def fast_get_geolocation_data(request: Request) -> Response:
+    return await project.get_geolocation_data_service.get_geolocation_data(
+        request.path_params["ip_address"]
+    )
+
+
+async def fast_get_user_rate_limit(request: Request) -> Response:
+    return await project.get_user_rate_limit_service.get_user_rate_limit(
+        request.path_params["user_id"]
+    )
+
+
+# The hottest GET endpoints are served by plain Starlette routes placed ahead of
+# the FastAPI ones, skipping dependency resolution and the per-route error
+# wrapper.
+app.router.routes[0:0] = [
+    Route("/geolocation/{ip_address}", fast_get_geolocation_data, methods=["GET"]),
+    Route("/ratelimit/{user_id}", fast_get_user_rate_limit, methods=["GET"]),
+]
+
+# Starlette routes are left out of the OpenAPI schema, so the fast routes are
+# described by FastAPI routes over the service functions they call. These are
+# only used to generate the schema and never serve requests.
+FAST_ROUTE_DOCS = [
+    APIRoute(
+        "/geolocation/{ip_address}",
+        project.get_geolocation_data_service.get_geolocation_data,
+        methods=["GET"],
+        name="api_get_get_geolocation_data",
+        description="Retrieves geolocation data for a given IP address.",
+        response_model=project.get_geolocation_data_service.GeolocationDataResponse,
+    ),
+    APIRoute(
+        "/ratelimit/{user_id}",
+        project.get_user_rate_limit_service.get_user_rate_limit,
+        methods=["GET"],
+        name="api_get_get_user_rate_limit",
+        description="Retrieves the current rate limit settings for a specific user or API key.",
+        response_model=project.get_user_rate_limit_service.GetUserRateLimitResponse,
+    ),
+]
+
+
+def openapi() -> Dict[str, Any]:
+    if app.openapi_schema is None:
+        app.openapi_schema = get_openapi(
+            title=app.title,
+            version=app.version,
+            description=app.description,
+            routes=[*FAST_ROUTE_DOCS, *app.routes],
         )
+    return app.openapi_schema
+
+
+app.openapi = openapi
 
 
 @app.post(
@@ -82,30 +197,6 @@ async def api_post_create_api_key(
         )
 
 
-@app.get(
-    "/ratelimit/{user_id}",
-    response_model=project.get_user_rate_limit_service.GetUserRateLimitResponse,
-)
-async def api_get_get_user_rate_limit(
-    user_id: str,
-) -> project.get_user_rate_limit_service.GetUserRateLimitResponse | Response:
-    """
-    Retrieves the current rate limit settings for a specific user or API key.
-    """
-    try:
-        res = await project.get_user_rate_limit_service.get_user_rate_limit(user_id)
-        return res
-    except Exception as e:
-        logger.exception("Error processing request")
-        res = dict()
-        res["error"] = str(e)
-        return Response(
-            content=jsonable_encoder(res),
-            status_code=500,
-            media_type="application/json",
-        )
-
-
 @app.patch(
     "/ratelimit/update/{user_id}",
     response_model=project.update_user_rate_limit_service.UpdateUserRateLimitResponse,
@@ -121,6 +212,8 @@ async def api_patch_update_user_rate_limit(
             user_id, limit, windowSec
         )
         return res
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("Error processing request")
         res = dict()
@@ -138,15 +231,18 @@ async def api_patch_update_user_rate_limit(
 )
 async def api_post_bulk_geolocation_query(
     ip_addresses: List[str],
+    format: project.bulk_geolocation_query_service.BulkFormat = "aos",
 ) -> project.bulk_geolocation_query_service.BulkGeolocationQueryResponse | Response:
     """
     Processes a list of IP addresses and returns their geolocation data.
     """
     try:
         res = await project.bulk_geolocation_query_service.bulk_geolocation_query(
-            ip_addresses
+            ip_addresses, format
         )
         return res
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("Error processing request")
         res = dict()
@@ -180,3 +276,33 @@ async def api_get_verify_api_key(
             status_code=500,
             media_type="application/json",
         )
+
+
+if __name__ == "__main__":
+    # uvloop and httptools replace the pure-Python event loop and HTTP parser.
+    # Each worker is a separate process with its own connection pools, sized from
+    # WEB_CONCURRENCY when it imports this module. One worker per CPU by default.
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    if TABLE_PATH and os.getenv("GEOLOCATION_PRELOAD", "0") == "1":
+        # Packed once here, before the workers start and map it.
+        asyncio.run(
+            project.geolocation_table.pack_database(
+                os.environ["DATABASE_URL"], TABLE_PATH
+            )
+        )
+    uvicorn.run(
+        "project.server:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+        backlog=2048,
+        limit_concurrency=2000,
+        # Rate limits key anonymous callers on their address, which behind a load
+        # balancer is only known from X-Forwarded-For. Set FORWARDED_ALLOW_IPS to
+        # the proxies allowed to send it ("*" where only the proxy can reach us).
+        proxy_headers=True,
+        forwarded_allow_ips=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+    )
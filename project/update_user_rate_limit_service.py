@@ -1,5 +1,7 @@
 import prisma
 import prisma.models
+import project.ratelimit
+from fastapi import HTTPException
 from pydantic import BaseModel
 
 
@@ -18,7 +20,7 @@ async def update_user_rate_limit(
     user_id: str, limit: int, windowSec: int
 ) -> UpdateUserRateLimitResponse:
     """
-    Updates rate limit settings for a specific user or API key.
+    Updates rate limit settings for a specific user or API key, creating them if none exist yet.
 
     Args:
       user_id (str): The unique identifier of the user or API key whose rate limit settings are to be updated.
@@ -27,21 +29,31 @@ async def update_user_rate_limit(
 
     Returns:
       UpdateUserRateLimitResponse: Response model confirming the update of a user or API key's rate limit settings.
+
+    Raises:
+      HTTPException: If the limit or the window is below 1.
     """
-    try:
-        await prisma.models.RateLimit.prisma().update_many(
-            where={"key": user_id}, data={"limit": limit, "windowSec": windowSec}
-        )
-        return UpdateUserRateLimitResponse(
-            user_id=user_id,
-            limit=limit,
-            windowSec=windowSec,
-            status="Rate limit settings updated successfully.",
-        )
-    except Exception as e:
-        return UpdateUserRateLimitResponse(
-            user_id=user_id,
-            limit=0,
-            windowSec=0,
-            status=f"Failed to update rate limit settings: {e}",
+    if limit < 1 or windowSec < 1:
+        raise HTTPException(
+            status_code=422, detail="limit and windowSec must be at least 1."
         )
+    rate_limit = await prisma.models.RateLimit.prisma().upsert(
+        where={"key": user_id},
+        data={
+            "create": {"key": user_id, "limit": limit, "windowSec": windowSec},
+            "update": {"limit": limit, "windowSec": windowSec},
+        },
+    )
+    await project.ratelimit.store_limit(
+        user_id,
+        rate_limit.limit,
+        rate_limit.windowSec,
+        rate_limit.createdAt,
+        rate_limit.updatedAt,
+    )
+    return UpdateUserRateLimitResponse(
+        user_id=user_id,
+        limit=limit,
+        windowSec=windowSec,
+        status="Rate limit settings updated successfully.",
+    )